@@ -6,114 +6,898 @@ This avoids Optimum (which lacks Moonshine support) and instead uses torch.onnx.
 with the official remote code from the model repo (trust_remote_code=True).
 
 Outputs (by default into ./assets/onnx-ar):
-  - encoder.onnx                : encoder last_hidden_state
-  - decoder.onnx                : decoder logits
-  - tokenizer.json / preprocessor_config.json (copied from HF)
+  - encoder.onnx                : encoder last_hidden_state (input_values only, static
+                                  shape, with --fixed-seconds N)
+  - cross_kv.onnx               : encoder_hidden_states -> per-layer cross-attention K/V
+                                  (present_key_values.{i}.encoder.{key,value}), once per clip
+  - decoder.onnx                : decoder hidden_states + present self-attention K/V
+                                  (feed past_key_values.{i}.{key,value}, starting with
+                                  past_seq=0, and the cross K/V as past_key_values.{i}.encoder.*)
+  - lm_head.onnx                : proj_out, hidden_states -> logits
+  - encoder_int8.onnx / decoder_int8.onnx (with --quantize int8, if they pass the gate)
+  - lm_head_int4.onnx           : int4 weight-only (MatMulNBits) lm head (with --quantize int8,
+                                  if greedy token choices match lm_head.onnx)
+  - encoder.fp16.onnx           : fp16-weight encoder with fp32 I/O (with --fp16, if it
+                                  stays close to encoder.onnx)
+  - *.ort                       : ORT flatbuffer copies of the final models (with --ort-format)
+  - tokenizer.json / preprocessor_config.json (copied from HF, other processor files
+                                  dropped and the preprocessor config trimmed)
 
-Quantization (optional --quantize int8) uses onnxruntime.quantization.quantize_dynamic.
+Quantization (optional --quantize int8) uses onnxruntime.quantization.quantize_static
+in QDQ format on a quant_pre_process'd copy of each graph, calibrated on noise clips run
+through the processor (encoder) and on first and later decode steps against the traced
+encoder output (decoder), so MatMul/Gemm/Conv run as real int8 kernels.
+--quant-mode dynamic falls back to weight-only quantize_dynamic restricted to MatMul/Gemm;
+--quant-ops overrides the quantized op set for either mode. Each *_int8.onnx is then
+timed against its fp32 source on the tracing input; if it is slower, fails to load or
+diverges numerically it is renamed to *_int8.reject.onnx. --validate-providers xnnpack,cpu
+then profiles the surviving quantized models once on each listed execution provider (CPU
+fallback on, as in the app), lists the quantized nodes the EP leaves to the CPU fallback
+and exits non-zero if a session fails to build or run.
 
 Usage:
   python scripts/export_moonshine_ar_onnx.py --output-dir ./assets/onnx-ar --seconds 6 --quantize int8
 
 Requirements:
-  pip install torch transformers onnx onnxruntime
+  pip install torch transformers numpy onnx onnxruntime
+  pip install onnxconverter-common   # only for --fp16
+  pip install soundfile librosa      # only for --calib-wav
 """
 
 from __future__ import annotations
 
 import argparse
+import json
+import multiprocessing
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+import numpy as np
 import torch
 from transformers import AutoProcessor, AutoModelForSpeechSeq2Seq
 
 
-def export_encoder(model, sample_inputs, out_path: Path):
+# Opset 17+ keeps LayerNormalization as a single op instead of a ReduceMean/Sub/Pow chain.
+OPSET = 20
+
+ENCODER_INPUTS = ["input_values", "attention_mask"]
+
+
+def check_onnx(path: Path) -> bool:
+    """Validate an exported graph; returns True if its weights live in external data files.
+
+    torch.onnx.export switches to external data on its own once a model crosses the 2GB
+    protobuf limit, so the graph is checked without pulling those weights into memory.
+    """
+    import onnx
+    from onnx.external_data_helper import uses_external_data
+
+    model = onnx.load(str(path), load_external_data=False)
+    onnx.checker.check_model(model)
+    return any(uses_external_data(t) for t in model.graph.initializer)
+
+
+def load_calib_audio(path: str, sr: int, sample_len: int) -> torch.Tensor:
+    """Load a mono clip at sr, trimmed or zero-padded to sample_len samples."""
+    import librosa
+    import soundfile as sf
+
+    audio, file_sr = sf.read(path, dtype="float32", always_2d=True)
+    audio = audio.mean(axis=1)
+    if file_sr != sr:
+        audio = librosa.resample(audio, orig_sr=file_sr, target_sr=sr)
+    audio = np.pad(audio[:sample_len], (0, max(0, sample_len - len(audio))))
+    return torch.from_numpy(audio.astype(np.float32)).unsqueeze(0)
+
+
+def check_parity(module, path: Path, names, check_inputs, atol: float = 1e-4):
+    """Compare every ORT output of path with module(*args) for each input tuple.
+
+    On mismatch path is deleted and a RuntimeError raised, so a graph that is only correct
+    at the traced shapes (or broken by the fusions) never reaches quantization.
+    """
+    sess = make_session(path)
+    output_names = [o.name for o in sess.get_outputs()]
+    for args in check_inputs:
+        with torch.no_grad():
+            expected = module(*args)
+        if not isinstance(expected, tuple):
+            expected = (expected,)
+        actual = sess.run(None, {name: t.numpy() for name, t in zip(names, args)})
+        assert len(actual) == len(expected), (len(actual), len(expected))
+        for name, got, want in zip(output_names, actual, expected):
+            try:
+                np.testing.assert_allclose(got, want.numpy(), rtol=0, atol=atol)
+            except AssertionError as e:
+                path.unlink(missing_ok=True)
+                shapes = [tuple(t.shape) for t in args]
+                raise RuntimeError(f"{path.name}:{name} diverges from PyTorch at {shapes}") from e
+    print(f"✔ {path.name} matches PyTorch on all outputs at {len(check_inputs)} input shapes")
+
+
+def export_encoder(model, sample_inputs, out_path: Path, fixed_length: bool = False):
+    """Export the encoder to out_path; returns a parity check to rerun on rewritten copies."""
+
     class EncoderWrapper(torch.nn.Module):
         def __init__(self, inner):
             super().__init__()
             self.inner = inner
 
-        def forward(self, input_values, attention_mask):
+        def forward(self, input_values, attention_mask=None):
             return self.inner.model.encoder(
                 input_values=input_values, attention_mask=attention_mask
             ).last_hidden_state
 
-    encoder = EncoderWrapper(model)
-    encoder.eval()
-    input_values = sample_inputs["input_values"]
-    attention_mask = sample_inputs["attention_mask"]
-
-    torch.onnx.export(
-        encoder,
-        (input_values, attention_mask),
-        out_path,
-        input_names=["input_values", "attention_mask"],
-        output_names=["encoder_hidden_states"],
-        opset_version=18,
-        dynamo=False,
-        dynamic_axes={
+    # A fixed-length clip is never padded, so its mask would be all ones; leaving it out
+    # entirely drops the mask arithmetic and lets the attention fusions match.
+    names = ENCODER_INPUTS[:1] if fixed_length else ENCODER_INPUTS
+    sample_args = tuple(sample_inputs[name] for name in names)
+    dynamic_axes = None
+    if not fixed_length:
+        dynamic_axes = {
             "input_values": {1: "audio_len"},
             "attention_mask": {1: "audio_len"},
             "encoder_hidden_states": {1: "time"},
-        },
+        }
+
+    # Trace once up front (skipping check_trace's extra forward pass) and hand the
+    # ScriptModule to the exporter, all without building an autograd graph.
+    wrapper = EncoderWrapper(model)
+    with torch.no_grad():
+        encoder = torch.jit.trace(wrapper, sample_args, check_trace=False)
+        torch.onnx.export(
+            encoder,
+            sample_args,
+            out_path,
+            input_names=names,
+            output_names=["encoder_hidden_states"],
+            opset_version=OPSET,
+            dynamo=False,
+            dynamic_axes=dynamic_axes,
+        )
+    shape = "static" if fixed_length else "dynamic"
+    print(f"✔ Encoder ONNX saved: {out_path} ({shape} audio_len)")
+
+    check_inputs = [sample_args]
+    if not fixed_length:
+        # Twice the traced length exercises the audio_len dynamic axis.
+        check_inputs.append(tuple(torch.cat([t, t.flip(-1)], dim=1) for t in sample_args))
+    check_parity(wrapper, out_path, names, check_inputs)
+    return lambda path: check_parity(wrapper, path, names, check_inputs)
+
+
+def extract_features(processor, audio: np.ndarray, sr: int, return_tensors: str = "pt"):
+    """Run the feature extractor directly on one unpadded mono clip.
+
+    Skips the processor wrapper (and its trust_remote_code dispatch) and the padding path,
+    so input_values is exactly the clip length and audio_len stays a pure dynamic axis.
+    """
+    inputs = processor.feature_extractor(
+        audio,
+        sampling_rate=sr,
+        return_tensors=return_tensors,
+        padding=False,
+        return_attention_mask=True,
     )
-    print(f"✔ Encoder ONNX saved: {out_path}")
+    assert inputs["input_values"].shape[-1] == audio.shape[-1], inputs["input_values"].shape
+    return inputs
 
 
-def export_decoder(model, encoder_hidden, out_path: Path):
+def encoder_feeds(inputs, fixed_length: bool = False):
+    """ORT feeds for the encoder from processor outputs (torch or numpy)."""
+    names = ENCODER_INPUTS[:1] if fixed_length else ENCODER_INPUTS
+    return {name: np.asarray(inputs[name]) for name in names}
+
+
+def decoder_past_spec(config):
+    """Decoder cache input names and the per-tensor shape, with an empty seq axis.
+
+    Returns the self-attention names (past_key_values.{i}.{key,value}), the
+    cross-attention names (past_key_values.{i}.encoder.{key,value}) and the shape.
+    """
+    heads = config.decoder_num_attention_heads
+    kv_heads = getattr(config, "decoder_num_key_value_heads", None) or heads
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // heads
+    layers = range(config.decoder_num_hidden_layers)
+    self_names = [f"past_key_values.{i}.{kind}" for i in layers for kind in ("key", "value")]
+    cross_names = [
+        f"past_key_values.{i}.encoder.{kind}" for i in layers for kind in ("key", "value")
+    ]
+    return self_names, cross_names, (1, kv_heads, 0, head_dim)
+
+
+def present_names(past_names):
+    return [n.replace("past_key_values", "present_key_values") for n in past_names]
+
+
+def empty_past_feeds(config):
+    """Zero-length self-attention past feeds for the first decoding step."""
+    names, _, shape = decoder_past_spec(config)
+    return {name: np.zeros(shape, dtype=np.float32) for name in names}
+
+
+def export_decoder(model, encoder_hidden, out_path: Path, cross_kv_path: Path):
+    """Export the per-step decoder to out_path and its cross-attention K/V graph.
+
+    cross_kv_path maps encoder_hidden_states to every layer's cross-attention K/V once
+    per utterance; the decoder takes those plus the self-attention past as inputs, so a
+    decode step never re-projects the encoder frames. Returns the decoder's parity check.
+    """
+    from transformers.cache_utils import DynamicCache, EncoderDecoderCache
+
+    class CrossKVWrapper(torch.nn.Module):
+        def __init__(self, inner):
+            super().__init__()
+            self.inner = inner
+
+        def forward(self, encoder_hidden_states):
+            # One dummy decoder step fills the cross-attention cache; only the K/V
+            # projections of encoder_hidden_states feed the outputs, so tracing prunes
+            # the rest of the decoder from the graph.
+            cache = EncoderDecoderCache(DynamicCache(), DynamicCache())
+            self.inner.model.decoder(
+                input_ids=torch.zeros((1, 1), dtype=torch.long),
+                encoder_hidden_states=encoder_hidden_states,
+                encoder_attention_mask=None,
+                past_key_values=cache,
+                use_cache=True,
+            )
+            cross = cache.cross_attention_cache
+            return tuple(t for i in range(len(cross)) for t in cross[i][:2])
+
     class DecoderWrapper(torch.nn.Module):
         def __init__(self, inner):
             super().__init__()
             self.inner = inner
 
-        def forward(self, decoder_input_ids, encoder_hidden_states):
-            dec = self.inner.model.decoder(
+        def forward(self, decoder_input_ids, *past_kv):
+            # past_kv is flat: self-attention (layer0.key, layer0.value, layer1.key, ...)
+            # followed by cross-attention K/V in the same order.
+            n = len(past_kv) // 2
+            self_cache, cross_cache = DynamicCache(), DynamicCache()
+            for i in range(0, n, 2):
+                self_cache.update(past_kv[i], past_kv[i + 1], i // 2)
+                cross_cache.update(past_kv[n + i], past_kv[n + i + 1], i // 2)
+            # A filled cross cache is marked as updated, so attention reads K/V from it
+            # and this placeholder only signals cross-attention; it drops out of the graph.
+            cross_k = past_kv[n]
+            encoder_stub = cross_k.new_zeros(
+                (cross_k.shape[0], cross_k.shape[2], self.inner.config.hidden_size)
+            )
+            out = self.inner.model.decoder(
                 input_ids=decoder_input_ids,
-                encoder_hidden_states=encoder_hidden_states,
+                encoder_hidden_states=encoder_stub,
                 encoder_attention_mask=None,
-                use_cache=False,
-            ).last_hidden_state
-            return self.inner.proj_out(dec)
+                past_key_values=EncoderDecoderCache(self_cache, cross_cache),
+                use_cache=True,
+            )
+            present = out.past_key_values.self_attention_cache
+            present_kv = [t for i in range(n // 2) for t in present[i][:2]]
+            return (out.last_hidden_state, *present_kv)
 
+    cross_kv = CrossKVWrapper(model)
     decoder = DecoderWrapper(model)
-    decoder.eval()
 
-    vocab = model.config.vocab_size
+    self_names, cross_names, past_shape = decoder_past_spec(model.config)
     sample_tokens = torch.zeros((1, 4), dtype=torch.long)
-    sample_enc = torch.zeros_like(encoder_hidden)
-    torch.onnx.export(
-        decoder,
-        (sample_tokens, sample_enc),
-        out_path,
-        input_names=["decoder_input_ids", "encoder_hidden_states"],
-        output_names=["logits"],
-        opset_version=18,
-        dynamo=False,
-        dynamic_axes={
-            "decoder_input_ids": {1: "seq"},
-            "encoder_hidden_states": {1: "time"},
-            "logits": {1: "seq", 2: "vocab"},
-        },
+    enc = encoder_hidden.clone()
+    empty_past = [torch.zeros(past_shape) for _ in self_names]
+    with torch.no_grad():
+        sample_cross = cross_kv(enc)
+        # The cached path has to match the decoder attending to the encoder directly.
+        reference = model.model.decoder(
+            input_ids=sample_tokens, encoder_hidden_states=enc, use_cache=False
+        ).last_hidden_state
+        cached = decoder(sample_tokens, *empty_past, *sample_cross)[0]
+        torch.testing.assert_close(cached, reference)
+
+    with torch.no_grad():
+        torch.onnx.export(
+            cross_kv,
+            (enc,),
+            cross_kv_path,
+            input_names=["encoder_hidden_states"],
+            output_names=present_names(cross_names),
+            opset_version=OPSET,
+            dynamo=False,
+            dynamic_axes={
+                "encoder_hidden_states": {1: "time"},
+                **{name: {2: "time"} for name in present_names(cross_names)},
+            },
+        )
+    print(f"✔ Cross-attention K/V ONNX saved: {cross_kv_path}")
+
+    longer_enc = torch.randn(1, enc.shape[1] * 2, enc.shape[2])
+    check_parity(cross_kv, cross_kv_path, ["encoder_hidden_states"], [(enc,), (longer_enc,)])
+
+    # Trace with a non-empty past so no zero-length branch gets baked into the graph;
+    # past_seq stays dynamic and accepts 0 on the first step.
+    sample_past = [torch.zeros(past_shape[:2] + (2,) + past_shape[3:]) for _ in self_names]
+    with torch.no_grad():
+        torch.onnx.export(
+            decoder,
+            (sample_tokens, *sample_past, *sample_cross),
+            out_path,
+            input_names=["decoder_input_ids", *self_names, *cross_names],
+            output_names=["hidden_states", *present_names(self_names)],
+            opset_version=OPSET,
+            dynamo=False,
+            dynamic_axes={
+                "decoder_input_ids": {1: "seq"},
+                "hidden_states": {1: "seq"},
+                **{name: {2: "past_seq"} for name in self_names},
+                **{name: {2: "time"} for name in cross_names},
+                **{name: {2: "total_seq"} for name in present_names(self_names)},
+            },
+        )
+    print(f"✔ Decoder ONNX saved: {out_path} (kv-cache layers={len(self_names) // 2})")
+
+    # First step (4-token prefix, empty past) plus a later step with a longer encoder
+    # output and a non-empty past, so seq, time and past_seq all move off the trace.
+    later_past = [torch.randn(past_shape[:2] + (3,) + past_shape[3:]) for _ in self_names]
+    with torch.no_grad():
+        longer_cross = cross_kv(longer_enc)
+    names = ["decoder_input_ids", *self_names, *cross_names]
+    check_inputs = [
+        (sample_tokens, *empty_past, *sample_cross),
+        (sample_tokens[:, :1], *later_past, *longer_cross),
+    ]
+    check_parity(decoder, out_path, names, check_inputs)
+    return lambda path: check_parity(decoder, path, names, check_inputs)
+
+
+def export_lm_head(model, out_path: Path):
+    class LMHeadWrapper(torch.nn.Module):
+        def __init__(self, proj_out):
+            super().__init__()
+            self.proj_out = proj_out
+
+        def forward(self, hidden_states):
+            return self.proj_out(hidden_states)
+
+    lm_head = LMHeadWrapper(model.proj_out)
+
+    vocab = model.config.vocab_size
+    sample_hidden = torch.randn(1, 4, model.config.hidden_size)
+    with torch.no_grad():
+        torch.onnx.export(
+            lm_head,
+            (sample_hidden,),
+            out_path,
+            input_names=["hidden_states"],
+            output_names=["logits"],
+            opset_version=OPSET,
+            dynamo=False,
+            dynamic_axes={
+                "hidden_states": {1: "seq"},
+                "logits": {1: "seq"},
+            },
+        )
+    print(f"✔ LM head ONNX saved: {out_path} (vocab={vocab})")
+
+    check_parity(lm_head, out_path, ["hidden_states"], [(sample_hidden,), (sample_hidden[:, :1],)])
+
+
+def optimize_graph(
+    path: Path,
+    num_heads: int,
+    hidden_size: int,
+    external_data: bool = False,
+    check=None,
+):
+    """Run ORT's transformer fusions (attention, LayerNorm, Gelu) on path.
+
+    Moonshine is BART-shaped, so the "bart" fusion patterns apply. opt_level=1 keeps the
+    graph portable; higher levels bake in layouts for the export machine's CPU. The fused
+    graph is written to a scratch dir and only replaces path once check (the export's
+    PyTorch parity test) passes on it; otherwise the unfused export is kept.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        # Same file name, so external data sidecars keep resolving after the move.
+        opt_path = Path(tmp) / path.name
+        try:
+            from onnxruntime.transformers.optimizer import optimize_model
+
+            optimized = optimize_model(
+                str(path),
+                model_type="bart",
+                num_heads=num_heads,
+                hidden_size=hidden_size,
+                opt_level=1,
+                use_gpu=False,
+            )
+            optimized.save_model_to_file(str(opt_path), use_external_data_format=external_data)
+            if check is not None:
+                check(opt_path)
+        except Exception as e:
+            print(f"Graph optimization skipped for {path.name}: {e}")
+            return
+        for f in Path(tmp).iterdir():
+            shutil.move(str(f), path.with_name(f.name))
+    print(f"✔ Optimized {path.name}: {optimized.get_fused_operator_statistics()}")
+
+
+def encoder_calib_feeds(
+    processor,
+    sr: int,
+    sample_len: int,
+    n: int = 20,
+    fixed_length: bool = False,
+    calib_audio: np.ndarray | None = None,
+):
+    """Encoder calibration inputs: the --calib-wav clip at a few gains, then noise.
+
+    Silence is left out on purpose: it pins the frontend activations at their floor and
+    skews the calibrated ranges.
+    """
+    rng = np.random.default_rng(0)
+    clips = []
+    if calib_audio is not None:
+        for gain in (1.0, 0.5, 0.25, 2.0):
+            clips.append(np.clip(calib_audio * gain, -1.0, 1.0).astype(np.float32))
+    while len(clips) < n:
+        amp = 10 ** rng.uniform(-3, -0.5)
+        clips.append((rng.standard_normal(sample_len) * amp).astype(np.float32))
+
+    feeds = []
+    for clip in clips[:n]:
+        inputs = extract_features(processor, clip, sr, return_tensors="np")
+        feeds.append(encoder_feeds(inputs, fixed_length))
+    return feeds
+
+
+def decoder_step_feeds(
+    decoder_path: Path, cross_kv_path: Path, encoder_hidden, config, n: int = 20
+):
+    """Decoder feeds for calibration and gating, alternating the two steps the app runs.
+
+    Even entries are first steps (random token prefix, empty past); odd entries feed one
+    token on top of the past the fp32 decoder returns for the preceding prefix.
+    """
+    rng = np.random.default_rng(0)
+    self_names, cross_names, _ = decoder_past_spec(config)
+    enc = encoder_hidden.numpy()
+    cross_out = make_session(cross_kv_path).run(None, {"encoder_hidden_states": enc})
+    cross = dict(zip(cross_names, cross_out))
+    decoder = make_session(decoder_path)
+    feeds = []
+    for i in range(n):
+        if i % 2 == 0:
+            seq = 1 + (i // 2) % 8
+            tokens = rng.integers(0, config.vocab_size, size=(1, seq), dtype=np.int64)
+            feeds.append({"decoder_input_ids": tokens, **empty_past_feeds(config), **cross})
+        else:
+            present = decoder.run(None, feeds[-1])[1:]
+            token = rng.integers(0, config.vocab_size, size=(1, 1), dtype=np.int64)
+            feeds.append({"decoder_input_ids": token, **dict(zip(self_names, present)), **cross})
+    return feeds
+
+
+def pre_process(path: Path, external_data: bool = False) -> Path:
+    """Symbolic shape inference + ORT graph optimization before quantization.
+
+    With external data the weights go to a single <pre>.onnx.data sidecar (see
+    pre_data_path) instead of one file per tensor.
+    """
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    pre_path = path.with_suffix(".pre.onnx")
+    quant_pre_process(
+        str(path),
+        str(pre_path),
+        skip_optimization=False,
+        skip_onnx_shape=False,
+        skip_symbolic_shape=False,
+        save_as_external_data=external_data,
+        all_tensors_to_one_file=True,
+        external_data_location=pre_data_path(pre_path).name,
     )
-    print(f"✔ Decoder ONNX saved: {out_path} (vocab={vocab})")
+    print(f"✔ Pre-processed -> {pre_path.name}")
+    return pre_path
+
+
+def pre_data_path(pre_path: Path) -> Path:
+    return pre_path.with_name(pre_path.name + ".data")
+
+
+def convert_fp16(path: Path, external_data: bool = False):
+    """Write <stem>.fp16.onnx next to path; inputs/outputs stay fp32 for the RN runtime."""
+    try:
+        import onnx
+        from onnxconverter_common import float16
+
+        fp16_path = path.with_name(path.stem + ".fp16.onnx")
+        model = float16.convert_float_to_float16(
+            onnx.load(str(path)), keep_io_types=True, disable_shape_infer=False
+        )
+        onnx.save(
+            model,
+            str(fp16_path),
+            save_as_external_data=external_data,
+            location=fp16_path.name + ".data",
+        )
+        print(f"✔ FP16 -> {fp16_path.name}")
+        return fp16_path
+    except Exception as e:
+        print(f"FP16 conversion skipped for {path.name}: {e}")
+        return None
+
 
+# Default ops per quantization mode. Dynamic quantization wraps every op it touches in
+# DynamicQuantizeLinear + MatMulInteger, which only pays off for MatMul/Gemm on CPU.
+QUANT_OPS = {
+    "static": ["MatMul", "Gemm", "Conv"],
+    "dynamic": ["MatMul", "Gemm"],
+}
 
-def quantize_int8(path: Path):
+
+def quantize_int8(
+    path: Path,
+    calib_feeds=None,
+    external_data: bool = False,
+    mode: str = "static",
+    op_types=None,
+):
+    pre_path = path.with_suffix(".pre.onnx")
+    q_path = path.with_name(path.stem + "_int8.onnx")
     try:
-        from onnxruntime.quantization import quantize_dynamic, QuantType
-
-        q_path = path.with_name(path.stem + "_int8.onnx")
-        quantize_dynamic(
-            str(path),
-            str(q_path),
-            weight_type=QuantType.QInt8,
-            optimize_model=False,
+        from onnxruntime.quantization import (
+            CalibrationDataReader,
+            QuantFormat,
+            QuantType,
+            quantize_dynamic,
+            quantize_static,
         )
-        print(f"✔ Quantized -> {q_path.name}")
+
+        class MoonshineCalibReader(CalibrationDataReader):
+            def __init__(self, feeds):
+                self.feeds = iter(feeds)
+
+            def get_next(self):
+                return next(self.feeds, None)
+
+        op_types = op_types or QUANT_OPS[mode]
+        pre_path = pre_process(path, external_data)
+        # per_channel stays off: per-channel scales on 3D MatMul weights make ORT fail at
+        # runtime with "b zero point is not valid". The vocab projection, which would
+        # benefit most from finer scales, is exported separately and block-quantized to
+        # int4 by quantize_int4.
+        if mode == "static":
+            quantize_static(
+                str(pre_path),
+                str(q_path),
+                MoonshineCalibReader(calib_feeds),
+                quant_format=QuantFormat.QDQ,
+                activation_type=QuantType.QInt8,
+                weight_type=QuantType.QInt8,
+                per_channel=False,
+                reduce_range=False,
+                op_types_to_quantize=op_types,
+                use_external_data_format=external_data,
+            )
+        else:
+            quantize_dynamic(
+                str(pre_path),
+                str(q_path),
+                weight_type=QuantType.QInt8,
+                op_types_to_quantize=op_types,
+                per_channel=False,
+                reduce_range=True,
+                optimize_model=False,
+                use_external_data_format=external_data,
+            )
+        print(f"✔ Quantized ({mode}, {','.join(op_types)}) -> {q_path.name}")
+        return q_path
     except Exception as e:
+        # Don't let a partial write or an earlier run's model pass as this run's result.
+        q_path.unlink(missing_ok=True)
         print(f"Quantization skipped for {path.name}: {e}")
+        return None
+    finally:
+        pre_path.unlink(missing_ok=True)
+        pre_data_path(pre_path).unlink(missing_ok=True)
+
+
+def quantize_int4(path: Path, block_size: int = 32):
+    """Weight-only int4 (MatMulNBits) quantization for the bandwidth-bound vocab matmul."""
+    q_path = path.with_name(path.stem + "_int4.onnx")
+    try:
+        import onnx
+        from onnxruntime.quantization.matmul_4bits_quantizer import MatMul4BitsQuantizer
+
+        quantizer = MatMul4BitsQuantizer(
+            onnx.load(str(path)), block_size=block_size, is_symmetric=True
+        )
+        quantizer.process()
+        quantizer.model.save_model_to_file(str(q_path))
+        print(f"✔ Quantized (int4, block_size={block_size}) -> {q_path.name}")
+        return q_path
+    except Exception as e:
+        q_path.unlink(missing_ok=True)
+        print(f"Int4 quantization skipped for {path.name}: {e}")
+        return None
+
+
+def convert_to_ort(paths):
+    """Write a .ort flatbuffer next to each model for faster cold-start loading on device.
+
+    The converter runs in a scratch dir so its <stem>.required_operators.config build
+    files stay out of the asset dir; only the .ort is moved next to the model.
+    """
+    for path in paths:
+        with tempfile.TemporaryDirectory() as tmp:
+            result = subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "onnxruntime.tools.convert_onnx_models_to_ort",
+                    str(path),
+                    f"--output_dir={tmp}",
+                    "--optimization_style=Fixed",
+                    "--target_platform=arm",
+                ],
+                capture_output=True,
+                text=True,
+            )
+            ort_path = Path(tmp) / (path.stem + ".ort")
+            if result.returncode != 0 or not ort_path.exists():
+                err = (result.stderr or result.stdout).strip().splitlines()
+                reason = err[-1] if err else result.returncode
+                print(f"ORT format skipped for {path.name}: {reason}")
+                continue
+            shutil.move(str(ort_path), path.with_suffix(".ort"))
+        print(f"✔ ORT format -> {path.with_suffix('.ort').name}")
+
+
+# The RN client only reads the BPE vocab and the audio frontend settings.
+KEEP_PROCESSOR_FILES = {"tokenizer.json", "preprocessor_config.json"}
+PREPROCESSOR_KEYS = (
+    "sampling_rate",
+    "feature_size",
+    "chunk_length",
+    "n_fft",
+    "hop_length",
+    "padding_value",
+    "do_normalize",
+)
+
+
+def save_processor(processor, out_dir: Path):
+    """save_pretrained into a scratch dir and copy out only what the RN bundle needs.
+
+    Processor files left in out_dir by an earlier, unpruned export are removed as well.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        processor.save_pretrained(tmp)
+        for f in Path(tmp).iterdir():
+            if f.name in KEEP_PROCESSOR_FILES:
+                shutil.copyfile(f, out_dir / f.name)
+            elif (out_dir / f.name).is_file():
+                (out_dir / f.name).unlink()
+
+    config_path = out_dir / "preprocessor_config.json"
+    if config_path.exists():
+        config = json.loads(config_path.read_text())
+        config = {k: config[k] for k in PREPROCESSOR_KEYS if k in config}
+        config_path.write_text(json.dumps(config, indent=2) + "\n")
+
+
+# --validate-providers names -> ORT execution providers.
+PROVIDERS = {
+    "cpu": "CPUExecutionProvider",
+    "xnnpack": "XnnpackExecutionProvider",
+    "nnapi": "NnapiExecutionProvider",
+    "coreml": "CoreMLExecutionProvider",
+}
+
+
+def make_session(
+    path: Path,
+    threads: int | None = None,
+    provider: str = "CPUExecutionProvider",
+    profile_prefix: str | None = None,
+):
+    import onnxruntime as ort
+
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if threads:
+        opts.intra_op_num_threads = threads
+    if profile_prefix:
+        opts.enable_profiling = True
+        opts.profile_file_prefix = profile_prefix
+    # Like the app, keep CPU as the fallback for nodes the EP doesn't take.
+    providers = [provider]
+    if provider != "CPUExecutionProvider":
+        providers.append("CPUExecutionProvider")
+    return ort.InferenceSession(str(path), sess_options=opts, providers=providers)
+
+
+def provider_list(value: str):
+    names = [name for name in value.split(",") if name]
+    unknown = [name for name in names if name not in PROVIDERS]
+    if unknown:
+        raise argparse.ArgumentTypeError(
+            f"unknown provider(s) {','.join(unknown)}; choose from {','.join(PROVIDERS)}"
+        )
+    return names
+
+
+QUANTIZED_OPS = {
+    "QuantizeLinear",
+    "DequantizeLinear",
+    "DynamicQuantizeLinear",
+    "MatMulInteger",
+    "ConvInteger",
+    "MatMulNBits",
+}
+
+
+def node_placement(sess, feeds):
+    """Run one profiled pass; returns {(op_type, provider): node count}."""
+    sess.run(None, feeds)
+    profile = Path(sess.end_profiling())
+    try:
+        events = json.loads(profile.read_text())
+    finally:
+        profile.unlink(missing_ok=True)
+    placed = {}
+    for event in events:
+        args = event.get("args", {})
+        name = event.get("name", "")
+        if event.get("cat") == "Node" and name.endswith("_kernel_time") and "provider" in args:
+            placed.setdefault((args["op_name"], args["provider"]), set()).add(name)
+    return {key: len(nodes) for key, nodes in placed.items()}
+
+
+def validate_providers(path: Path, feeds, providers) -> bool:
+    """Run path on each requested EP this wheel ships, CPU fallback on as in the app.
+
+    Fails only when the session can't be built or run. Quantized nodes (Q/DQ, QLinear*,
+    *Integer, MatMulNBits) left on the CPU fallback are listed but expected: no mobile EP
+    implements MatMulNBits or the dynamic-quantization ops, and the app runs them on CPU.
+    """
+    import onnxruntime as ort
+
+    available = ort.get_available_providers()
+    ok = True
+    for name in providers:
+        provider = PROVIDERS[name]
+        if provider not in available:
+            print(f"  {path.name} on {name}: skipped (not in this onnxruntime build)")
+            continue
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                sess = make_session(path, provider=provider, profile_prefix=str(Path(tmp) / "ort"))
+                placed = node_placement(sess, feeds)
+        except Exception as e:
+            ok = False
+            print(f"✘ {path.name} on {name}: {type(e).__name__}: {e}")
+            continue
+        fallback = {
+            op: count
+            for (op, ep), count in placed.items()
+            if ep == "CPUExecutionProvider"
+            and ep != provider
+            and (op in QUANTIZED_OPS or op.startswith("QLinear"))
+        }
+        on_ep = sum(count for (_, ep), count in placed.items() if ep == provider)
+        print(f"✔ {path.name} on {name} ({on_ep} nodes on {provider})")
+        if fallback:
+            ops = ", ".join(f"{op} x{count}" for op, count in sorted(fallback.items()))
+            print(f"  quantized nodes on the CPU fallback: {ops}")
+    return ok
+
+
+def median_latency(sess, feeds_list, runs: int):
+    """Median wall time of one pass over feeds_list, plus every output of that pass."""
+    for feeds in feeds_list:  # warm-up
+        sess.run(None, feeds)
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        outs = [out for feeds in feeds_list for out in sess.run(None, feeds)]
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)), outs
+
+
+def gate_int8(path: Path, q_path: Path, feeds_list, runs: int = 20, atol: float = 1e-1) -> bool:
+    """Keep q_path only if it loads, beats fp32 latency and stays close on every output.
+
+    Rejected models are renamed to *_int8.reject.onnx so the fp32 file stays canonical;
+    that includes the case where the fp32 baseline itself can't run, since nothing then
+    vouches for the int8 model. Both sessions run single-threaded so intra-op parallelism
+    doesn't mask the comparison.
+    """
+    try:
+        fp32_s, fp32_out = median_latency(make_session(path, threads=1), feeds_list, runs)
+    except Exception as e:
+        reason = f"fp32 baseline {path.name} failed to run: {e}"
+    else:
+        try:
+            int8_s, int8_out = median_latency(make_session(q_path, threads=1), feeds_list, runs)
+        except Exception as e:
+            reason = f"failed to run: {e}"
+        else:
+            timing = f"fp32 {fp32_s * 1e3:.1f}ms vs int8 {int8_s * 1e3:.1f}ms"
+            if int8_s >= fp32_s:
+                reason = f"not faster, {timing}"
+            elif not all(np.allclose(a, b, atol=atol) for a, b in zip(fp32_out, int8_out)):
+                err = max(float(np.max(np.abs(a - b))) for a, b in zip(fp32_out, int8_out))
+                reason = f"outputs diverge (max abs err {err:.3f} > {atol})"
+            else:
+                print(f"✔ {q_path.name} passed gate ({timing})")
+                return True
+
+    return reject(q_path, reason)
+
+
+def reject(q_path: Path, reason: str) -> bool:
+    """Move q_path aside as *.reject.onnx so the fp32 model stays canonical."""
+    reject_path = q_path.with_name(q_path.stem + ".reject.onnx")
+    q_path.replace(reject_path)
+    print(f"✘ {q_path.name} rejected: {reason} -> {reject_path.name}")
+    return False
+
+
+def gate_fp16(path: Path, fp16_path: Path, feeds_list, atol: float = 5e-2) -> bool:
+    """Keep fp16_path only if it loads and every output stays within atol of fp32.
+
+    The tolerance is loose on purpose: fp16 weights shift activations slightly everywhere,
+    while a broken conversion (overflowed initializers, lost Casts) is off by far more.
+    """
+    try:
+        fp32_sess, fp16_sess = make_session(path), make_session(fp16_path)
+        fp32 = [out for feeds in feeds_list for out in fp32_sess.run(None, feeds)]
+        fp16 = [out for feeds in feeds_list for out in fp16_sess.run(None, feeds)]
+    except Exception as e:
+        return reject(fp16_path, f"failed to run: {e}")
+
+    err = max(float(np.max(np.abs(a - b))) for a, b in zip(fp32, fp16))
+    if err > atol:
+        return reject(fp16_path, f"outputs diverge (max abs err {err:.3f} > {atol})")
+    print(f"✔ {fp16_path.name} passed check (max abs err {err:.4f})")
+    return True
+
+
+def gate_int4(
+    path: Path,
+    q_path: Path,
+    hidden_states,
+    top_k: int = 5,
+    min_top1: float = 0.95,
+    min_in_top_k: float = 0.99,
+) -> bool:
+    """Keep the int4 lm head only if greedy decoding would pick the same tokens.
+
+    int4 logits drift too far for an allclose test, so the gate compares rankings on
+    real decoder hidden states: the fp32 argmax must match the int4 argmax on min_top1
+    of the positions and fall inside the int4 top-k on min_in_top_k of them.
+    """
+    try:
+        fp32_sess, int4_sess = make_session(path), make_session(q_path)
+        fp32 = [fp32_sess.run(None, {"hidden_states": h})[0] for h in hidden_states]
+        int4 = [int4_sess.run(None, {"hidden_states": h})[0] for h in hidden_states]
+    except Exception as e:
+        return reject(q_path, f"failed to run: {e}")
+
+    vocab = fp32[0].shape[-1]
+    fp32_top1 = np.concatenate([x.reshape(-1, vocab).argmax(-1) for x in fp32])
+    int4_logits = np.concatenate([x.reshape(-1, vocab) for x in int4])
+    int4_top_k = np.argsort(-int4_logits, axis=-1)[:, :top_k]
+    top1 = float(np.mean(int4_top_k[:, 0] == fp32_top1))
+    in_top_k = float(np.mean((int4_top_k == fp32_top1[:, None]).any(-1)))
+    summary = f"top-1 {top1:.1%}, in top-{top_k} {in_top_k:.1%} over {len(fp32_top1)} positions"
+    if top1 < min_top1 or in_top_k < min_in_top_k:
+        return reject(q_path, f"token rankings diverge ({summary})")
+    print(f"✔ {q_path.name} passed gate ({summary})")
+    return True
 
 
 def main():
@@ -121,7 +905,50 @@ def main():
     parser.add_argument("--model-id", default="UsefulSensors/moonshine-tiny-ar")
     parser.add_argument("--output-dir", default="./assets/onnx-ar")
     parser.add_argument("--seconds", type=float, default=6.0, help="Dummy audio length for tracing")
+    parser.add_argument(
+        "--fixed-seconds",
+        type=float,
+        default=None,
+        help="Export the encoder for exactly N seconds of audio: static shapes and no "
+        "attention_mask input (overrides --seconds)",
+    )
+    parser.add_argument(
+        "--calib-wav",
+        default=None,
+        help="Real audio to trace, calibrate and gate with instead of noise "
+        "(needs soundfile, librosa)",
+    )
     parser.add_argument("--quantize", choices=["int8", None], default="int8")
+    parser.add_argument(
+        "--fp16",
+        action="store_true",
+        help="Also write encoder.fp16.onnx (fp16 weights, fp32 inputs/outputs)",
+    )
+    parser.add_argument(
+        "--validate-providers",
+        type=provider_list,
+        default=None,
+        help=f"Comma-separated EPs to run the int8 models on ({','.join(PROVIDERS)}); "
+        "EPs missing from the installed onnxruntime are skipped",
+    )
+    parser.add_argument(
+        "--ort-format",
+        action="store_true",
+        help="Also convert each final .onnx to the ORT flatbuffer format (.ort)",
+    )
+    parser.add_argument(
+        "--quant-mode",
+        choices=["static", "dynamic"],
+        default="static",
+        help="static: calibrated QDQ int8; dynamic: weight-only int8",
+    )
+    parser.add_argument(
+        "--quant-ops",
+        type=lambda s: [op for op in s.split(",") if op],
+        default=None,
+        help="Comma-separated op types to quantize (default: MatMul,Gemm,Conv for "
+        "static, MatMul,Gemm for dynamic)",
+    )
     args = parser.parse_args()
 
     out_dir = Path(args.output_dir)
@@ -129,16 +956,27 @@ def main():
 
     print("Loading processor/model...")
     processor = AutoProcessor.from_pretrained(args.model_id, trust_remote_code=True)
-    model = AutoModelForSpeechSeq2Seq.from_pretrained(args.model_id, trust_remote_code=True)
+    model = AutoModelForSpeechSeq2Seq.from_pretrained(
+        args.model_id,
+        trust_remote_code=True,
+        low_cpu_mem_usage=True,
+        torch_dtype=torch.float32,
+    )
     model.eval()
 
     sr = processor.feature_extractor.sampling_rate
-    sample_len = int(args.seconds * sr)
-    dummy_audio = torch.zeros((1, sample_len), dtype=torch.float32)
-    sample_inputs = processor(audio=dummy_audio.numpy(), sampling_rate=sr, return_tensors="pt")
+    fixed_length = args.fixed_seconds is not None
+    sample_len = int((args.fixed_seconds if fixed_length else args.seconds) * sr)
+    if args.calib_wav:
+        dummy_audio = load_calib_audio(args.calib_wav, sr, sample_len)
+    else:
+        # Silence drives the frontend to degenerate activations; use speech-level noise.
+        torch.manual_seed(0)
+        dummy_audio = torch.randn((1, sample_len), dtype=torch.float32) * 0.05
+    sample_inputs = extract_features(processor, dummy_audio.squeeze(0).numpy(), sr)
 
     print("Running encoder once to get shape...")
-    with torch.no_grad():
+    with torch.inference_mode():
         enc_out = model.model.encoder(
             input_values=sample_inputs["input_values"],
             attention_mask=sample_inputs["attention_mask"],
@@ -147,19 +985,134 @@ def main():
 
     encoder_path = out_dir / "encoder.onnx"
     decoder_path = out_dir / "decoder.onnx"
+    cross_kv_path = out_dir / "cross_kv.onnx"
 
-    export_encoder(model, sample_inputs, encoder_path)
-    export_decoder(model, enc_out, decoder_path)
+    encoder_parity = export_encoder(model, sample_inputs, encoder_path, fixed_length)
+    encoder_external = check_onnx(encoder_path)
+    optimize_graph(
+        encoder_path,
+        model.config.encoder_num_attention_heads,
+        model.config.hidden_size,
+        external_data=encoder_external,
+        check=encoder_parity,
+    )
+    if args.fp16:
+        fp16_path = convert_fp16(encoder_path, external_data=encoder_external)
+        if fp16_path is not None:
+            gate_fp16(encoder_path, fp16_path, [encoder_feeds(sample_inputs, fixed_length)])
+    # The decoder export only needs enc_out as its sample tensor; drop encoder weights.
+    model.model.encoder.to("meta")
+    decoder_parity = export_decoder(model, enc_out, decoder_path, cross_kv_path)
+    check_onnx(cross_kv_path)
+    decoder_external = check_onnx(decoder_path)
+    optimize_graph(
+        decoder_path,
+        model.config.decoder_num_attention_heads,
+        model.config.hidden_size,
+        external_data=decoder_external,
+        check=decoder_parity,
+    )
+    lm_head_path = out_dir / "lm_head.onnx"
+    export_lm_head(model, lm_head_path)
+    check_onnx(lm_head_path)
 
+    provider_failures = []
     if args.quantize == "int8":
-        quantize_int8(encoder_path)
-        quantize_int8(decoder_path)
+        static = args.quant_mode == "static"
+        # Each model writes its own files, so quantize them in parallel; any failure is
+        # caught inside quantize_int8/quantize_int4 and doesn't cancel the other jobs.
+        # Spawned workers start clean instead of forking a parent that already runs torch
+        # and ORT thread pools and holds the model in memory.
+        with ProcessPoolExecutor(
+            max_workers=min(2, os.cpu_count() or 1),
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as pool:
+            encoder_job = pool.submit(
+                quantize_int8,
+                encoder_path,
+                (
+                    encoder_calib_feeds(
+                        processor,
+                        sr,
+                        sample_len,
+                        fixed_length=fixed_length,
+                        calib_audio=dummy_audio.squeeze(0).numpy() if args.calib_wav else None,
+                    )
+                    if static
+                    else None
+                ),
+                external_data=encoder_external,
+                mode=args.quant_mode,
+                op_types=args.quant_ops,
+            )
+            decoder_job = pool.submit(
+                quantize_int8,
+                decoder_path,
+                (
+                    decoder_step_feeds(decoder_path, cross_kv_path, enc_out, model.config)
+                    if static
+                    else None
+                ),
+                external_data=decoder_external,
+                mode=args.quant_mode,
+                op_types=args.quant_ops,
+            )
+            lm_head_job = pool.submit(quantize_int4, lm_head_path)
+        encoder_q = encoder_job.result()
+        decoder_q = decoder_job.result()
+        lm_head_q = lm_head_job.result()
+
+        encoder_int8_feeds = [encoder_feeds(sample_inputs, fixed_length)]
+        # A first step and a one-token step on a non-empty past, like the app's decode loop.
+        decoder_int8_feeds = decoder_step_feeds(
+            decoder_path, cross_kv_path, enc_out, model.config, n=2
+        )
+
+        print("Checking int8 models against fp32...")
+        kept = []
+        if encoder_q is not None and gate_int8(encoder_path, encoder_q, encoder_int8_feeds):
+            kept.append((encoder_q, encoder_int8_feeds))
+        if decoder_q is not None and gate_int8(decoder_path, decoder_q, decoder_int8_feeds):
+            kept.append((decoder_q, decoder_int8_feeds))
+        if lm_head_q is not None:
+            # Real decoder hidden states from first and later steps, not random vectors.
+            decoder = make_session(decoder_path)
+            hidden = [
+                decoder.run(None, feeds)[0]
+                for feeds in decoder_step_feeds(decoder_path, cross_kv_path, enc_out, model.config)
+            ]
+            if gate_int4(lm_head_path, lm_head_q, hidden):
+                kept.append((lm_head_q, [{"hidden_states": hidden[0]}]))
+
+        if args.validate_providers:
+            print("Validating quantized models on execution providers...")
+            for q_path, feeds_list in kept:
+                if not validate_providers(q_path, feeds_list[0], args.validate_providers):
+                    provider_failures.append(q_path.name)
+
+    if args.ort_format:
+        convert_to_ort(
+            sorted(p for p in out_dir.glob("*.onnx") if not p.name.endswith(".reject.onnx"))
+        )
 
     # copy tokenizer files
-    processor.save_pretrained(out_dir)
+    save_processor(processor, out_dir)
     print("✔ Tokenizer/preprocessor saved.")
 
-    print("\nExport complete. Point ONNX_CONFIG in App.tsx to files in", out_dir)
+    print("\nExport complete:")
+    for f in sorted(out_dir.iterdir()):
+        if f.is_file():
+            print(f"  {f.name:<36} {f.stat().st_size / 1e6:8.2f} MB")
+    print(
+        "Per clip: encoder -> cross_kv once, then per token decoder (feeding "
+        "present_key_values.* back as past_key_values.*) -> lm_head on the last position.\n"
+        "src/MoonshineONNX.ts still expects a single logits decoder without a KV cache; "
+        "update its decode loop (see README) before pointing ONNX_CONFIG at",
+        out_dir,
+    )
+
+    if provider_failures:
+        sys.exit(f"Execution provider validation failed for: {', '.join(provider_failures)}")
 
 
 if __name__ == "__main__":